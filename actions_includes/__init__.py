@@ -17,17 +17,20 @@
 # SPDX-License-Identifier: Apache-2.0
 
 
-import copy
+import collections
+import functools
 import hashlib
 import os
 import pathlib
+import posixpath
 import pprint
-import subprocess
+import re
+import shutil
+import sys
 import argparse
 
 from ruamel import yaml
 from ruamel.yaml import resolver
-from ruamel.yaml import util
 from ruamel.yaml.comments import CommentedMap
 from ruamel.yaml.constructor import RoundTripConstructor
 from ruamel.yaml.nodes import MappingNode
@@ -35,6 +38,7 @@ from ruamel.yaml.nodes import MappingNode
 from pprint import pprint as p
 
 from . import expressions as exp
+from . import output
 from .files import LocalFilePath, RemoteFilePath
 from .files import get_filepath
 from .files import get_filepath_data
@@ -62,27 +66,13 @@ def get_action_data(current_action, action_name):
         action_dirpath = action_name
     printerr("get_action_data:", current_action, action_name, action_dirpath)
 
-    errors = {}
-    for f in ACTION_YAML_NAMES:
-        action_filepath = action_dirpath._replace(path=str(action_dirpath.path)+f)
-
-        data = get_filepath_data(action_filepath)
+    try:
+        action_filepath, yaml_data = load_yaml_from_dir(
+            action_dirpath, tuple(ACTION_YAML_NAMES))
+    except IOError as e:
+        raise IOError('Did not find {} (in {}), errors:\n{}'.format(
+            action_name, current_action, e)) from None
 
-        errors[action_filepath] = data
-        if isinstance(data, str):
-            break
-    else:
-        raise IOError(
-            '\n'.join([
-                    'Did not find {} (in {}), errors:'.format(
-                        action_name, current_action),
-                ] + [
-                    '  {}: {}'.format(k, str(v))
-                    for k, v in sorted(errors.items())
-                ]))
-
-    printerr("Including:", action_filepath)
-    yaml_data = yaml_load(action_filepath, data)
     assert 'runs' in yaml_data, (type(yaml_data), yaml_data)
     assert yaml_data['runs'].get(
         'using', None) == 'includes', pprint.pformat(yaml_data)
@@ -99,30 +89,110 @@ def get_workflow_data(current_workflow, jobs_name):
     jobs_dirpath = get_filepath(current_workflow, jobs_name, 'workflow')
     printerr("get_workflow_data:", current_workflow, jobs_name, jobs_dirpath)
 
-    errors = {}
-    for f in JOBS_YAML_NAMES:
-        jobs_filepath = jobs_dirpath._replace(path=str(jobs_dirpath.path)+f)
+    try:
+        jobs_filepath, yaml_data = load_yaml_from_dir(
+            jobs_dirpath, tuple(JOBS_YAML_NAMES))
+    except IOError as e:
+        raise IOError('Did not find {} (in {}), errors:\n{}'.format(
+            jobs_name, current_workflow, e)) from None
+
+    assert 'jobs' in yaml_data, pprint.pformat(yaml_data)
+    return jobs_filepath, yaml_data
+
 
-        data = get_filepath_data(jobs_filepath)
+@functools.lru_cache(maxsize=None)
+def load_yaml_from_dir(dirpath, yaml_names):
+    """Load the first of `yaml_names` which exists in `dirpath`.
 
-        errors[jobs_filepath] = data
+    The same action or workflow is often included many times, so the result is
+    cached. The expansion never modifies the data of included files (it builds
+    a new copy as part of expanding the input expressions), so the yaml data
+    returned is shared rather than copied.
+    """
+    filepaths = files.get_dir_filepaths(dirpath, yaml_names)
+    # Look for all the possible names at once rather than one after another.
+    files.prefetch_filepath_data(filepaths)
+
+    errors = {}
+    for filepath in filepaths:
+        data = get_filepath_data(filepath)
+
+        errors[filepath] = data
         if isinstance(data, str):
             break
     else:
-        raise IOError(
-            '\n'.join([
-                    'Did not find {} (in {}), errors:'.format(
-                        jobs_name, current_workflow),
-                ] + [
-                    '  {}: {}'.format(k, str(v))
-                    for k, v in sorted(errors.items())
-                ]))
-
-    printerr("Including:", jobs_filepath)
-    yaml_data = yaml_load(jobs_filepath, data)
-    assert 'jobs' in yaml_data, pprint.pformat(yaml_data)
-    return jobs_filepath, yaml_data
+        raise IOError('\n'.join(
+            '  {}: {}'.format(k, str(v)) for k, v in sorted(errors.items())))
 
+    printerr("Including:", filepath)
+    yaml_data = yaml_load(filepath, data, shared=True)
+    if 'includes' in data and isinstance(yaml_data, dict):
+        prefetch_includes(filepath, yaml_data)
+    return filepath, yaml_data
+
+
+# The files which have already had their includes prefetched.
+PREFETCHED = set()
+
+
+def prefetch_includes(current_filepath, yaml_data):
+    """Start downloading the remote files included by yaml_data.
+
+    The includes are followed a level at a time, so all the remote files at
+    the same depth are downloaded in parallel before the expansion gets to
+    them. Includes which depend on inputs can't be followed and are fetched
+    when they are expanded. Callers skip this when the raw text doesn't contain
+    `includes` at all, which is the case for most included actions.
+    """
+    to_scan = [(current_filepath, yaml_data)]
+    while to_scan:
+        dirpaths = []
+        for filepath, data in to_scan:
+            if filepath in PREFETCHED:
+                continue
+            PREFETCHED.add(filepath)
+
+            includes = []
+            for step in data.get('runs', {}).get('steps', []):
+                includes.append((step.get('includes', None), 'action', ACTION_YAML_NAMES))
+            for job in data.get('jobs', {}).values():
+                includes.append((job.get('includes', None), 'workflow', JOBS_YAML_NAMES))
+                for step in job.get('steps', []):
+                    includes.append((step.get('includes', None), 'action', ACTION_YAML_NAMES))
+
+            for name, filetype, yaml_names in includes:
+                # Names which depend on inputs are only known once expanded.
+                if not isinstance(name, str) or isinstance(name, exp.Expression):
+                    continue
+                if '${{' in name:
+                    continue
+                dirpaths.append((get_filepath(filepath, name, filetype), yaml_names))
+
+        dirpaths = [
+            files.get_dir_filepaths(dirpath, yaml_names)
+            for dirpath, yaml_names in dirpaths]
+        files.prefetch_filepath_data(
+            filepath
+            for filepaths in dirpaths
+            for filepath in filepaths
+            if isinstance(filepath, RemoteFilePath))
+
+        # Look in the files just fetched for the next level of includes.
+        to_scan = []
+        for filepaths in dirpaths:
+            for filepath in filepaths:
+                data = get_filepath_data(filepath)
+                if not isinstance(data, str):
+                    continue
+                if 'includes' in data:
+                    try:
+                        data = yaml_parse(data)
+                    except yaml.YAMLError:
+                        # Reported when the file is actually included.
+                        break
+                    if isinstance(data, dict):
+                        to_scan.append((filepath, data))
+                break
 
 
 # -----------------------------------------------------------------------------
@@ -202,6 +272,19 @@ def expand_input_expressions(yaml_item, context):
     [('f', 'g'), ('c', 'd')]
 
     """
+    # Most values are plain strings without any expressions in them, so check
+    # for them before walking through the container types. The loops below
+    # also check for them inline, saving a recursive call per value. An exact
+    # type check is enough for most strings, only the str subclasses (ruamel's
+    # scalar strings and exp.Value) need the isinstance checks.
+    if type(yaml_item) is str or (
+            isinstance(yaml_item, str) and not isinstance(yaml_item, exp.Expression)):
+        if '${{' not in yaml_item:
+            return yaml_item
+        return exp.eval(yaml_item, context)
+    elif isinstance(yaml_item, (bool, int, float, None.__class__)):
+        return yaml_item
+
     marker = []
     new_yaml_item = marker
     if isinstance(yaml_item, CommentedMapExpression):
@@ -229,28 +312,27 @@ def expand_input_expressions(yaml_item, context):
         setattr(new_yaml_item, yaml.comments.merge_attrib, [])
 
         for k, v in yaml_item.non_merged_items():
-            new_yaml_item[k] = expand_input_expressions(v, context)
+            if type(v) is not str or '${{' in v:
+                v = expand_input_expressions(v, context)
+            new_yaml_item[k] = v
 
         if new_merge_attrib:
             new_yaml_item.add_yaml_merge(new_merge_attrib)
 
     elif isinstance(yaml_item, dict):
         new_yaml_item = {}
-        for k, v in list(yaml_item.items()):
-            new_yaml_item[k] = expand_input_expressions(v, context)
+        for k, v in yaml_item.items():
+            if type(v) is not str or '${{' in v:
+                v = expand_input_expressions(v, context)
+            new_yaml_item[k] = v
     elif isinstance(yaml_item, list):
         new_yaml_item = []
-        for i in range(0, len(yaml_item)):
-            new_yaml_item.append(expand_input_expressions(yaml_item[i], context))
+        for v in yaml_item:
+            if type(v) is not str or '${{' in v:
+                v = expand_input_expressions(v, context)
+            new_yaml_item.append(v)
     elif isinstance(yaml_item, exp.Expression):
         new_yaml_item = exp.simplify(yaml_item, context)
-    elif isinstance(yaml_item, str):
-        if '${{' in yaml_item:
-            new_yaml_item = exp.eval(yaml_item, context)
-        else:
-            new_yaml_item = yaml_item
-    elif isinstance(yaml_item, (bool, int, float, None.__class__)):
-        return yaml_item
     else:
         raise TypeError('{} ({!r})'.format(type(yaml_item), yaml_item))
 
@@ -260,9 +342,9 @@ def expand_input_expressions(yaml_item, context):
 
 
 def get_needs(d):
-    needs = d.get('needs', [])
+    needs = d.get('needs', ())
     if isinstance(needs, str):
-        needs = [needs]
+        needs = (needs,)
     return needs
 
 
@@ -285,6 +367,26 @@ def get_if_exp(d):
     return exp.parse(v)
 
 
+def and_if(a, b):
+    """Combine two `if` conditions.
+
+    Most steps and jobs don't have a condition, so skip building an
+    expression when one side is just `True`.
+
+    >>> and_if(True, exp.Value('a'))
+    Value(a)
+    >>> and_if(exp.Value('a'), True)
+    Value(a)
+    >>> and_if(exp.Value('a'), exp.Value('b'))
+    and(Value(a), Value(b))
+    """
+    if a is True:
+        return b
+    if b is True:
+        return a
+    return exp.AndF(a, b)
+
+
 def resolve_paths(root_filepath, data):
     assert isinstance(root_filepath, files.FilePath), (type(root_filepath), root_filepath)
     assert isinstance(data, dict), (type(data), data)
@@ -339,8 +441,9 @@ def build_inputs(target_yamldata, include_yamldata, current_filepath):
 
     """
 
-    # Calculate the inputs dictionary
-    with_data = copy.copy(include_yamldata.get('with', {}))
+    # Calculate the inputs dictionary. The including step or job is replaced by
+    # the included data, so its `with` can be used without taking a copy.
+    with_data = include_yamldata.get('with', {})
 
     # FIXME: This is a hack to make sure that paths used in include values are
     # relative to the file they are defined in, not the place they are used.
@@ -348,6 +451,7 @@ def build_inputs(target_yamldata, include_yamldata, current_filepath):
         resolve_paths(current_filepath, with_data)
 
     inputs = {}
+    used = set()
     for in_name, in_info in target_yamldata.get('inputs', {}).items():
         if not in_info:
             in_info = {}
@@ -355,13 +459,15 @@ def build_inputs(target_yamldata, include_yamldata, current_filepath):
         marker = {}
         v = marker
 
-        # Set the default value
+        # Set the default value, the included yaml data is shared so take a
+        # copy rather than handing it out.
         if 'default' in in_info:
-            v = in_info['default']
+            v = yaml_copy(in_info['default'])
 
         # Override with the provided value
         if in_name in with_data:
-            v = with_data.pop(in_name)
+            v = with_data[in_name]
+            used.add(in_name)
 
         # Check the value is set if required.
         if in_info.get('required', False):
@@ -374,10 +480,10 @@ def build_inputs(target_yamldata, include_yamldata, current_filepath):
 
         inputs[in_name] = v
 
-    if with_data:
+    if len(used) != len(with_data):
         raise KeyError(
             "with statement had unused extra arguments: {}".format(
-                ", ".join('%s: %r' % (k,v) for k,v in with_data.items())
+                ", ".join('%s: %r' % (k,v) for k,v in with_data.items() if k not in used)
             )
         )
     return inputs
@@ -395,28 +501,39 @@ def add_github_context(context):
 
     if not github:
         # FIXME: pull the data from the local git repository.
-        github['sha'] = git_root_output = subprocess.check_output(
-            ['git', 'rev-parse', 'HEAD'])
+        import subprocess
+        github['sha'] = subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD']).decode('utf-8').strip()
 
-    assert not 'github' in context, pprint.format(context)
+    assert not 'github' in context, pprint.pformat(context)
     context['github'] = github
 
 
+# The keys which decide a step's type, in priority order (most common first).
+STEP_TYPES = ('run', 'uses', 'includes', 'includes-script')
+
+
 def step_type(m):
-    if 'run' in m:
-        return 'run'
-    elif 'uses' in m:
-        return 'uses'
-    elif 'includes' in m:
-        return 'includes'
-    elif 'includes-script' in m:
-        return 'includes-script'
-    else:
-        raise ValueError('Unknown step type:\n' + pprint.pformat(m) + '\n')
+    """
+    >>> step_type({'name': 'a', 'run': 'b'})
+    'run'
+    >>> step_type({'includes-script': 'a.py', 'shell': 'python'})
+    'includes-script'
+    >>> step_type({'name': 'a'})
+    Traceback (most recent call last):
+        ...
+    ValueError: Unknown step type:
+    {'name': 'a'}
+    <BLANKLINE>
+    """
+    for t in STEP_TYPES:
+        if t in m:
+            return t
+    raise ValueError('Unknown step type:\n' + pprint.pformat(m) + '\n')
 
 
 def expand_step_includes(current_filepath, include_step):
-    assert step_type(include_step) == 'includes', (current_filepath, include_step)
+    assert 'includes' in include_step, (current_filepath, include_step)
 
     include_filepath, include_yamldata = get_action_data(current_filepath, include_step['includes'])
     assert 'runs' in include_yamldata, pprint.pformat(include_yamldata)
@@ -427,9 +544,10 @@ def expand_step_includes(current_filepath, include_step):
     except KeyError as e:
         raise SyntaxError('{}: {} while processing {} included with\n{}'.format(
             current_filepath, e, include_filepath, pprint.pformat(include_step)))
-    if 'inputs' in include_yamldata:
-        del include_yamldata['inputs']
 
+    # Only the top level needs to differ from include_yamldata, so a shallow
+    # copy is enough. The expression evaluator requires a real dict here,
+    # which rules out a ChainMap overlay.
     context = dict(include_yamldata)
     context['inputs'] = input_data
 
@@ -440,11 +558,14 @@ def expand_step_includes(current_filepath, include_step):
     printdbg('Before data:')
     printdbg(include_yamldata)
 
-    # Do the input replacements in the yaml file.
+    # Do the input replacements in the yaml file. This gives a new copy of
+    # include_yamldata, which is shared and can't be modified.
     include_yamldata = expand_input_expressions(include_yamldata, context)
+    if 'inputs' in include_yamldata:
+        del include_yamldata['inputs']
 
     printdbg('---')
-    printdbg('After data:\n', pprint.pformat(include_yamldata))
+    printdbg('After data:\n', include_yamldata)
     printdbg('\n', end='')
 
     assert 'runs' in include_yamldata, pprint.pformat(include_yamldata)
@@ -454,12 +575,16 @@ def expand_step_includes(current_filepath, include_step):
 
     out = []
     for i, step in enumerate(include_yamldata['runs']['steps']):
-        step_if = exp.AndF(current_if, get_if_exp(step))
+        step_if = and_if(current_if, get_if_exp(step))
 
-        printdbg(f'Step {i} -', step.get('name', '????'))
-        printdbg('           Before If:', repr(step_if))
+        # The reprs are built before printdbg can check DEBUG, so only build
+        # them when they will be printed.
+        if output.DEBUG:
+            printdbg(f'Step {i} -', step.get('name', '????'))
+            printdbg('           Before If:', repr(step_if))
         step_if = exp.simplify(step_if, context)
-        printdbg('            After If:', repr(step_if))
+        if output.DEBUG:
+            printdbg('            After If:', repr(step_if))
 
         if isinstance(step_if, exp.Expression):
             step['if'] = step_if
@@ -475,11 +600,25 @@ def expand_step_includes(current_filepath, include_step):
     return out
 
 
+# The shell to use for an included script, based on its extension. Standard
+# shells don't need the `{0}` placeholder for the script file.
+SCRIPT_SHELLS = {
+    '.py': 'python',
+    '.ps1': 'pwsh',
+    '.cmd': 'cmd',
+    '.rb': 'ruby {0}',
+    '.pl': 'perl {0}',
+    '.cmake': 'cmake -P {0}',
+    '.sh': 'bash',
+}
+
+
 def expand_step_includes_script(current_filepath, v):
-    assert step_type(v) == 'includes-script', (current_filepath, v)
+    assert 'includes-script' in v, (current_filepath, v)
 
     script = v.pop('includes-script')
-    script_file = str((pathlib.Path('/'+current_filepath.path).parent / script).resolve())[1:]
+    script_file = posixpath.normpath(posixpath.join(
+        posixpath.dirname('/'+str(current_filepath.path)), script))[1:]
     printerr(f"Including script: {script} (relative to {current_filepath}) found at {script_file}")
 
     script_filepath = get_filepath(current_filepath, './'+script_file)
@@ -487,33 +626,15 @@ def expand_step_includes_script(current_filepath, v):
 
     v['run'] = script_data
     if 'shell' not in v:
-        if script.endswith('.py'):
-            # Standard shell, no `{0}` needed.
-            v['shell'] = 'python'
-        elif script.endswith('.ps1'):
-            # Standard shell, no `{0}` needed.
-            v['shell'] = 'pwsh'
-        elif script.endswith('.cmd'):
-            # Standard shell, no `{0}` needed.
-            v['shell'] = 'cmd'
-        elif script.endswith('.rb'):
-            # Non-standard shell, `{0}` needed.
-            v['shell'] = 'ruby {0}'
-        elif script.endswith('.pl'):
-            # Non-standard shell, `{0}` needed.
-            v['shell'] = 'perl {0}'
-        elif script.endswith('.cmake'):
-            # Non-standard shell, `{0}` needed.
-            v['shell'] = 'cmake -P {0}'
-        elif script.endswith('.sh'):
-            # Standard shell, no `{0}` needed.
-            v['shell'] = 'bash'
+        ext = script[script.rfind('.'):] if '.' in script else ''
+        if ext in SCRIPT_SHELLS:
+            v['shell'] = SCRIPT_SHELLS[ext]
 
     return expand_step_run(current_filepath, v)
 
 
 def expand_step_uses(current_filepath, v):
-    assert step_type(v) == 'uses', (current_filepath, v)
+    assert 'uses' in v, (current_filepath, v)
     # Support the `/{name}` format on `uses` values.
     if v['uses'].startswith('/'):
         v['uses'] = './.github/includes/actions' + v['uses']
@@ -522,36 +643,41 @@ def expand_step_uses(current_filepath, v):
 
 
 def expand_step_run(current_filepath, v):
-    assert step_type(v) == 'run', (current_filepath, v)
+    assert 'run' in v, (current_filepath, v)
     return v
 
 
+# Expanders for the step types which turn into a single step.
+STEP_EXPANDERS = {
+    'run': expand_step_run,
+    'uses': expand_step_uses,
+    'includes-script': expand_step_includes_script,
+}
+
+
 # -----------------------------------------------------------------------------
 
 
 def expand_job_steps(current_filepath, job_data):
     assert 'steps' in job_data, pprint.pformat(job_data)
 
-    steps = list((current_filepath, s) for s in job_data['steps'])
+    steps = collections.deque((current_filepath, s) for s in job_data['steps'])
 
     new_steps = []
     while steps:
-        step_filepath, step_data = steps.pop(0)
+        step_filepath, step_data = steps.popleft()
 
         st = step_type(step_data)
         if st != 'includes':
-            new_steps.append({
-                'run': expand_step_run,
-                'uses': expand_step_uses,
-                'includes-script': expand_step_includes_script,
-            }[st](step_filepath, step_data))
+            new_steps.append(STEP_EXPANDERS[st](step_filepath, step_data))
         else:
-            steps_to_add = expand_step_includes(step_filepath, step_data)
-            while steps_to_add:
-                new_step_filepath, new_step_data = steps_to_add.pop(-1)
-                steps.insert(0, (new_step_filepath, new_step_data))
+            # The included steps need to be expanded before any of the
+            # following steps.
+            steps.extendleft(reversed(expand_step_includes(step_filepath, step_data)))
 
-    job_data = copy.copy(job_data)
+    # The job data is either from the top level workflow or from an included
+    # workflow after its inputs were expanded, both of which are private
+    # copies, so the steps can be replaced in place.
     job_data['steps'] = new_steps
     return job_data
 
@@ -568,7 +694,6 @@ def expand_job_include(current_filepath, include_job):
     except KeyError as e:
         raise SyntaxError('{} while processing {} included with:\n{}'.format(
             e, include_filepath, pprint.pformat(include_job)))
-    del include_yamldata['inputs']
 
     context = dict(include_yamldata)
     context['inputs'] = input_data
@@ -582,9 +707,11 @@ def expand_job_include(current_filepath, include_job):
     printdbg('Before job data:')
     printdbg(include_yamldata)
 
-    # Do the input replacements in the yaml file.
+    # Do the input replacements in the yaml file. This gives a new copy of
+    # include_yamldata, which is shared and can't be modified.
     printdbg('---')
     include_yamldata = expand_input_expressions(include_yamldata, context)
+    del include_yamldata['inputs']
     printdbg('---')
 
     printdbg('After job data:')
@@ -597,13 +724,15 @@ def expand_job_include(current_filepath, include_job):
 def expand_workflow_jobs(current_workflow, current_workflow_data):
     assert 'jobs' in current_workflow_data, pprint.pformat(current_workflow_data)
 
-    jobs = list((current_workflow, k, v) for k, v in current_workflow_data['jobs'].items())
+    jobs = collections.deque(
+        (current_workflow, k, v) for k, v in current_workflow_data['jobs'].items())
 
     new_jobs = []
 
     while jobs:
-        current_filepath, job_name, job_data = jobs.pop(0)
-        printdbg('\nJob:', f'{job_name}#{len(new_jobs)}')
+        current_filepath, job_name, job_data = jobs.popleft()
+        if output.DEBUG:
+            printdbg('\nJob:', f'{job_name}#{len(new_jobs)}')
 
         if job_name is None:
             job_name = ''
@@ -626,18 +755,18 @@ def expand_workflow_jobs(current_workflow, current_workflow_data):
             included_job_name, included_job_data = included_jobs.pop(-1)
             new_job_name = job_name+included_job_name
 
-            new_needs = current_needs + [job_name+n for n in get_needs(included_job_data)]
+            new_needs = [*current_needs, *(job_name+n for n in get_needs(included_job_data))]
             if new_needs:
-                if len(new_needs) == 1:
-                    new_needs = new_needs.pop(0)
-                included_job_data['needs'] = new_needs
+                included_job_data['needs'] = new_needs[0] if len(new_needs) == 1 else new_needs
 
-            new_if = exp.AndF(current_if, get_if_exp(included_job_data))
+            new_if = and_if(current_if, get_if_exp(included_job_data))
 
-            printdbg(new_job_name)
-            printdbg('Before Job If:', repr(new_if))
+            if output.DEBUG:
+                printdbg(new_job_name)
+                printdbg('Before Job If:', repr(new_if))
             new_if = exp.simplify(new_if, context)
-            printdbg(' After Job If:', repr(new_if))
+            if output.DEBUG:
+                printdbg(' After Job If:', repr(new_if))
 
             if isinstance(new_if, exp.Expression):
                 included_job_data['if'] = current_if
@@ -648,15 +777,17 @@ def expand_workflow_jobs(current_workflow, current_workflow_data):
                 if 'if' in included_job_data:
                     del included_job_data['if']
 
-            jobs.insert(0, (include_filepath, new_job_name, included_job_data))
+            jobs.appendleft((include_filepath, new_job_name, included_job_data))
 
-    new_workflow = copy.copy(current_workflow_data)
+    # The workflow data is a private copy (see expand_job_steps), update the
+    # jobs in place.
+    new_workflow = current_workflow_data
 
-    job_names = []
+    job_names = set()
     # Set all the new jobs
     for job_name, job_data in new_jobs:
         new_workflow['jobs'][job_name] = job_data
-        job_names.append(job_name)
+        job_names.add(job_name)
     # Remove any jobs of the older jobs which still exist.
     for job_name in list(new_workflow['jobs'].keys()):
         if job_name not in job_names:
@@ -669,9 +800,13 @@ def expand_workflow_jobs(current_workflow, current_workflow_data):
 # ==============================================================
 
 
+# ruamel's util.RegExp wraps the pattern in a lazy proxy which every scalar
+# starting with `$` has to go through, so use a plain compiled pattern.
+RE_EXPRESSION_SCALAR = re.compile(u'^(?:\\${{[^}]*}})$')
+
 resolver.BaseResolver.add_implicit_resolver(
     u'tag:github.com,2020:expression',
-    util.RegExp(u'^(?:\\${{[^}]*}})$'),
+    RE_EXPRESSION_SCALAR,
     [u'$'], # - a list of first characters to match
 )
 
@@ -698,6 +833,8 @@ RoundTripConstructor.add_constructor(u'tag:github.com,2020:expression', construc
 
 
 class CommentedMapExpression(yaml.comments.CommentedMap):
+    __slots__ = ('exp_value',)
+
     def __init__(self, a0, *args, **kw):
         yaml.comments.CommentedMap.__init__(self, [], *args, **kw)
 
@@ -711,6 +848,9 @@ class CommentedMapExpression(yaml.comments.CommentedMap):
 
 
 class MapExpressionNode(yaml.nodes.MappingNode):
+    # The ruamel.yaml nodes don't have a __dict__, so don't add one.
+    __slots__ = ()
+
     def __init__(self, tag, value, *args, **kw):
         yaml.nodes.MappingNode.__init__(self, tag, value, *args, **kw)
 
@@ -729,35 +869,42 @@ class RoundTripConstructorWithExp(RoundTripConstructor):
 
         return RoundTripConstructor.construct_mapping(self, node, maptyp, deep)
 
+    def construct_yaml_str(self, node):
+        value = RoundTripConstructor.construct_yaml_str(self, node)
+        # Keys and short values (`steps`, `run`, `ubuntu-20.04`, ...) repeat
+        # all through the files, so share one copy of each. Quoted strings are
+        # ScalarString subclasses which can't be interned.
+        if type(value) is str and len(value) <= 64:
+            value = sys.intern(value)
+        return value
+
+
+RoundTripConstructorWithExp.add_constructor(
+    u'tag:yaml.org,2002:str', RoundTripConstructorWithExp.construct_yaml_str)
+
 
-class RoundTripLoaderWithExp(
-    yaml.reader.Reader,
-    yaml.scanner.RoundTripScanner,
-    yaml.parser.RoundTripParser,
-    yaml.composer.Composer,
-    RoundTripConstructorWithExp,
-    yaml.resolver.VersionedResolver,
-):
-    def __init__(self, stream, version=None, preserve_quotes=None):
-        # type: (StreamTextType, Optional[VersionType], Optional[bool]) -> None
-        # self.reader = Reader.__init__(self, stream)
-        self.comment_handling = None  # issue 385
-        yaml.reader.Reader.__init__(self, stream, loader=self)
-        yaml.scanner.RoundTripScanner.__init__(self, loader=self)
-        yaml.parser.RoundTripParser.__init__(self, loader=self)
-        yaml.composer.Composer.__init__(self, loader=self)
-        RoundTripConstructorWithExp.__init__(self, preserve_quotes=preserve_quotes, loader=self)
-        yaml.resolver.VersionedResolver.__init__(self, version, loader=self)
+# Reuse one YAML instance for all the loads, rather than building a new loader
+# (and initialising all of its mixins) for every file.
+YAML_LOADER = yaml.YAML(typ='rt')
+YAML_LOADER.Constructor = RoundTripConstructorWithExp
 
 
 # ==============================================================
 
 
+# The presenters below are registered on this class rather than on ruamel's
+# RoundTripRepresenter, so they don't change how anything else using ruamel
+# dumps yaml.
+class RoundTripDumperWithoutAliases(yaml.RoundTripDumper):
+    def ignore_aliases(self, data):
+        return True
+
+
 def exp_presenter(dumper, data):
     return dumper.represent_scalar('tag:github.com,2020:expression', '${{ '+str(data)+' }}')
 
 
-yaml.representer.RoundTripRepresenter.add_multi_representer(exp.Expression, exp_presenter)
+RoundTripDumperWithoutAliases.add_multi_representer(exp.Expression, exp_presenter)
 
 
 def map_exp_presenter(dumper, data):
@@ -765,7 +912,7 @@ def map_exp_presenter(dumper, data):
     return data.node
 
 
-yaml.representer.RoundTripRepresenter.add_representer(MapExpressionNode, map_exp_presenter)
+RoundTripDumperWithoutAliases.add_representer(MapExpressionNode, map_exp_presenter)
 
 
 # ==============================================================
@@ -793,12 +940,90 @@ class On:
         return dumper.represent_scalar('tag:yaml.org,2002:bool', 'on')
 
 
-yaml.representer.RoundTripRepresenter.add_representer(str, str_presenter)
-yaml.representer.RoundTripRepresenter.add_representer(None.__class__, none_presenter)
-yaml.representer.RoundTripRepresenter.add_representer(On, On.presenter)
+RoundTripDumperWithoutAliases.add_representer(str, str_presenter)
+RoundTripDumperWithoutAliases.add_representer(None.__class__, none_presenter)
+RoundTripDumperWithoutAliases.add_representer(On, On.presenter)
+
 
+def yaml_copy(data, memo=None):
+    """Copy the containers of a loaded yaml tree, sharing the (immutable) leaves.
 
-def yaml_load(current_action, yaml_data):
+    `copy.deepcopy` can't be used as ruamel's `CommentedMap.__deepcopy__`
+    doesn't understand `CommentedMapExpression` or the merge (`<<:`) keys.
+
+    >>> d = yaml_load(None, '''
+    ... a: &a
+    ...   b: [1, 2]
+    ... c:
+    ...   <<: *a
+    ...   d: ${{ e }}
+    ... f:
+    ...   <<: ${{ g }}
+    ... ''')
+    >>> c = yaml_copy(d)
+    >>> c == d, c is d, c['a'] is d['a'], c['a']['b'] is d['a']['b']
+    (True, False, False, False)
+    >>> c['a'] is c['c'].merge[0][1]
+    True
+    >>> list(c['c'].non_merged_items())
+    [('d', Value(e))]
+    >>> c['f'].merge
+    [(0, CommentedMap(Value(g)))]
+    >>> yaml_dump(None, c['c']) == yaml_dump(None, d['c'])
+    True
+    """
+    if memo is None:
+        memo = {}
+    if id(data) in memo:
+        return memo[id(data)]
+
+    if isinstance(data, CommentedMapExpression):
+        new_data = CommentedMapExpression(data.exp_value)
+        memo[id(data)] = new_data
+
+    elif isinstance(data, yaml.comments.CommentedMap):
+        new_data = yaml.comments.CommentedMap()
+        memo[id(data)] = new_data
+        data.copy_attributes(new_data)
+        setattr(new_data, yaml.comments.merge_attrib, [])
+
+        for k, v in data.non_merged_items():
+            new_data[k] = yaml_copy(v, memo)
+
+        new_merge_attrib = [
+            (i, yaml_copy(m, memo))
+            for i, m in getattr(data, yaml.comments.merge_attrib, [])
+        ]
+        if new_merge_attrib:
+            new_data.add_yaml_merge(new_merge_attrib)
+
+    elif isinstance(data, yaml.comments.CommentedSeq):
+        new_data = yaml.comments.CommentedSeq()
+        memo[id(data)] = new_data
+        data.copy_attributes(new_data)
+        new_data.extend(yaml_copy(v, memo) for v in data)
+
+    elif isinstance(data, dict):
+        new_data = {}
+        memo[id(data)] = new_data
+        for k, v in data.items():
+            new_data[k] = yaml_copy(v, memo)
+
+    elif isinstance(data, list):
+        new_data = []
+        memo[id(data)] = new_data
+        new_data.extend(yaml_copy(v, memo) for v in data)
+
+    else:
+        new_data = data
+
+    return new_data
+
+
+YAML_CACHE = {}
+
+
+def yaml_load(current_action, yaml_data, shared=False):
     """
 
     >>> d = yaml_load(None, '''
@@ -810,21 +1035,50 @@ def yaml_load(current_action, yaml_data):
     {'jobs': {'First': {'if': Value(hello)}}}
     >>> yaml_dump(None, d)
     'jobs:\\n  First:\\n    if: ${{ hello }}\\n'
+
+    Loading the same contents again gives a new copy of the data.
+    >>> d2 = yaml_load(None, '''
+    ... jobs:
+    ...   First:
+    ...     if: ${{ hello }}
+    ... ''')
+    >>> d2 == d, d2 is d, d2['jobs'] is d['jobs']
+    (True, False, False)
+
+    Unless `shared` is set, in which case the cached data is returned and must
+    not be modified.
+    >>> d3 = yaml_load(None, 'a: b', shared=True)
+    >>> d3 is yaml_load(None, 'a: b', shared=True)
+    True
     """
 
-    md5sum = hashlib.md5(yaml_data.encode('utf-8')).hexdigest()
-    printerr(f'Loading yaml file {current_action} with contents md5 of {md5sum}')
-    printdbg(yaml_data)
-    return yaml.load(yaml_data, Loader=RoundTripLoaderWithExp)
+    printerr(f'Loading yaml file {current_action}')
+    if output.DEBUG:
+        digest = hashlib.blake2b(yaml_data.encode('utf-8'), digest_size=8).hexdigest()
+        printdbg(f'Contents hash of {digest}')
+        printdbg(yaml_data)
+    # The expansion modifies the data it is given, so the cached copy is never
+    # handed out directly.
+    if shared:
+        return yaml_parse(yaml_data)
+    return yaml_copy(yaml_parse(yaml_data))
 
 
-class RoundTripDumperWithoutAliases(yaml.RoundTripDumper):
-    def ignore_aliases(self, data):
-        return True
+def yaml_parse(yaml_data):
+    """Parse yaml_data, returning the cached data which must not be modified."""
+    # The same action is often included many times, so only parse each unique
+    # file once. The contents themselves are the key, as hashing a str is
+    # cheaper than a checksum.
+    if yaml_data not in YAML_CACHE:
+        # There is no libyaml backed version of the round trip loader; the C
+        # loaders only produce plain dicts and lose the comments, key ordering
+        # and merge (`<<:`) information the expansion relies on.
+        YAML_CACHE[yaml_data] = YAML_LOADER.load(yaml_data)
+    return YAML_CACHE[yaml_data]
 
 
-def yaml_dump(current_action, data):
-    return yaml.dump(data, allow_unicode=True, width=1000, Dumper=RoundTripDumperWithoutAliases)
+def yaml_dump(current_action, data, stream=None):
+    return yaml.dump(data, stream, allow_unicode=True, width=1000, Dumper=RoundTripDumperWithoutAliases)
 
 
 # Enable pretty printing for the ruamel.yaml.comments objects
@@ -891,7 +1145,8 @@ pprint.PrettyPrinter._dispatch[yaml.comments.CommentedSet.__repr__] = commenteds
 # ==============================================================
 
 
-def expand_workflow(current_workflow, to_path, insert_check_steps: bool):
+def expand_workflow(current_workflow, to_path, insert_check_steps: bool, stream=None):
+    """Expand a workflow, returning the result or writing it to `stream`."""
     src_path = os.path.relpath('/'+str(current_workflow.path), start='/'+str(os.path.dirname(to_path)))
 
     workflow_filepath = get_filepath(current_workflow, './'+str(current_workflow.path))
@@ -900,10 +1155,15 @@ def expand_workflow(current_workflow, to_path, insert_check_steps: bool):
     workflow_data = get_filepath_data(workflow_filepath)
     if not isinstance(workflow_data, str):
         raise workflow_data
-    workflow_data = workflow_data.splitlines()
-    output = []
-    while workflow_data[0] and workflow_data[0][0] == '#':
-        output.append(workflow_data.pop(0))
+    # Find the end of the leading comment block without splitting up (and
+    # then joining back together) the whole file.
+    header_end = 0
+    while workflow_data.startswith('#', header_end):
+        header_end = workflow_data.find('\n', header_end) + 1
+        if not header_end:
+            header_end = len(workflow_data)
+    output = workflow_data[:header_end].splitlines()
+    workflow_data = workflow_data[header_end:]
 
     output.append("""
 # !! WARNING !!
@@ -914,7 +1174,9 @@ def expand_workflow(current_workflow, to_path, insert_check_steps: bool):
 # using the script from https://github.com/{}
 """.format(MARKER+str(src_path), INCLUDE_ACTION_NAME))
 
-    data = yaml_load(current_workflow, '\n'.join(workflow_data))
+    data = yaml_load(current_workflow, workflow_data)
+    if 'includes' in workflow_data:
+        prefetch_includes(current_workflow, data)
     data = expand_workflow_jobs(current_workflow, data)
     new_data = {}
     if True in data:
@@ -967,9 +1229,8 @@ def expand_workflow(current_workflow, to_path, insert_check_steps: bool):
         steps = j['steps']
         assert isinstance(steps, list), pprint.pformat(j)
 
-        for s in reversed(to_insert):
-            if insert_check_steps:
-                steps.insert(0, s)
+        if insert_check_steps:
+            steps[:0] = to_insert
 
     printdbg('')
     printdbg('Final yaml data:')
@@ -977,9 +1238,30 @@ def expand_workflow(current_workflow, to_path, insert_check_steps: bool):
     printdbg(data)
     printdbg('-'*75)
 
-    output.append(yaml_dump(current_workflow, data))
+    header = '\n'.join(output) + '\n'
+    if stream is None:
+        return header + yaml_dump(current_workflow, data)
+
+    stream.write(header)
+    yaml_dump(current_workflow, data, stream)
 
-    return '\n'.join(output)
+
+@functools.lru_cache(maxsize=1)
+def get_git_root():
+    """Find the top level directory of the git repository we are running in."""
+    if 'GIT_DIR' not in os.environ and 'GIT_WORK_TREE' not in os.environ:
+        # Walk up looking for `.git` (a directory, or a file for worktrees and
+        # submodules) to avoid starting a git process in the common case.
+        cwd = pathlib.Path.cwd().resolve()
+        for d in (cwd, *cwd.parents):
+            if (d / '.git').exists():
+                return d
+
+    # Only imported here as it is slow to import and rarely needed.
+    import subprocess
+    git_root_output = subprocess.check_output(
+        ['git', 'rev-parse', '--show-toplevel'])
+    return pathlib.Path(git_root_output.decode('utf-8').strip()).resolve()
 
 
 def main():
@@ -996,11 +1278,7 @@ def main():
 
     tfile = None
     try:
-        git_root_output = subprocess.check_output(
-            ['git', 'rev-parse', '--show-toplevel'])
-
-        repo_root = pathlib.Path(git_root_output.decode(
-            'utf-8').strip()).resolve()
+        repo_root = get_git_root()
 
         from_filename = args.in_workflow
         to_filename = args.out_workflow
@@ -1020,19 +1298,32 @@ def main():
                 outpath = outdir / f'{i}.{outfile}'
                 i += 1
 
+            # outdir is built from the already resolved repo_root, so the path
+            # doesn't need resolving again.
             tfile = outpath
-            to_abspath = outpath.resolve()
-            to_path = to_abspath.relative_to(repo_root)
+            to_abspath = outpath
+            to_path = outpath.relative_to(repo_root)
         else:
             printerr("Expanding", from_filename, "into", to_filename)
             to_abspath = pathlib.Path(to_filename).resolve()
             to_path = to_abspath.relative_to(repo_root)
 
         current_action = LocalFilePath(repo_root, str(from_path))
-        out_data = expand_workflow(current_action, to_path, insert_check)
-
-        with open(to_abspath, 'w') as f:
-            f.write(out_data)
+        # Stream into a temporary file next to the output, so a failed
+        # expansion doesn't leave behind a truncated workflow (or truncate the
+        # input when it is also the output).
+        tmp_abspath = to_abspath.with_name('{}.{}.tmp'.format(
+            to_abspath.name, os.getpid()))
+        try:
+            with open(tmp_abspath, 'w') as f:
+                expand_workflow(current_action, to_path, insert_check, f)
+            # Keep the permissions of the workflow being replaced.
+            if os.path.exists(to_abspath):
+                shutil.copymode(to_abspath, tmp_abspath)
+            os.replace(tmp_abspath, to_abspath)
+        finally:
+            if os.path.exists(tmp_abspath):
+                os.unlink(tmp_abspath)
 
         return 0
     finally:
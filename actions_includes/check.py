@@ -19,7 +19,6 @@
 
 import os
 import sys
-import urllib.request
 import pathlib
 import difflib
 import argparse
@@ -36,14 +35,20 @@ SHA = None
 def get_file(filename):
     workflow_url = f"https://raw.githubusercontent.com/{USER}/{REPO}/{SHA}/{filename}"
     print("Downloading:", workflow_url)
-    return urllib.request.urlopen(workflow_url).read().decode('utf-8')
+    # Go through the same caches as the includes, so files shared between the
+    # workflows being checked are only downloaded once.
+    workflow_data = actions_includes.files.get_filepath_data(
+        actions_includes.RemoteFilePath(USER, REPO, SHA, filename))
+    if not isinstance(workflow_data, str):
+        raise workflow_data
+    return workflow_data
 
 
 def main():
     ap = argparse.ArgumentParser(
         prog="check",
-        description="Assert a workflow produced by actions-includes is up to date")
-    ap.add_argument("workflow", type=str,
+        description="Assert workflows produced by actions-includes are up to date")
+    ap.add_argument("workflow", type=str, nargs='+',
         help="Path to workflow file to check, relative to repo root")
     args = ap.parse_args()
 
@@ -52,7 +57,14 @@ def main():
     USER, REPO = os.environ['GITHUB_REPOSITORY'].split('/', 1)
     SHA = os.environ['GITHUB_SHA']
 
-    workflow_file = args.workflow
+    # Check every workflow (rather than stopping at the first failure) so all
+    # the problems are reported, and keep the exit status to 0 or 1 as it is
+    # taken modulo 256.
+    failed = [check_workflow(workflow_file) for workflow_file in args.workflow]
+    return 1 if any(failed) else 0
+
+
+def check_workflow(workflow_file):
     workflow_data = get_file(workflow_file)
 
     # Workout what the source workflow file name was
@@ -64,7 +76,7 @@ def main():
         print('-'*75)
         print(workflow_data)
         print('-'*75)
-        sys.exit(1)
+        return 1
 
     workflow_srcfile = workflow_data[startpos+len(actions_includes.MARKER):endpos]
     workflow_srcpath = (pathlib.Path('/'+workflow_file).parent / workflow_srcfile).resolve()
@@ -18,6 +18,8 @@
 
 
 import collections.abc
+import copy
+import functools
 import json
 import re
 
@@ -287,18 +289,11 @@ def var_eval(v, context):
             ov[i] = var_eval(j, context)
 
     ctx = context
-    cv = list(ov)
-    while len(cv) > 0:
-        j = cv.pop(0)
+    for j in ov:
         if j not in ctx:
-            cv.insert(0, j)
-            break
+            return Lookup(ov)
         ctx = ctx[j]
-
-    if not cv:
-        return ctx
-    else:
-        return Lookup(ov)
+    return ctx
 
 
 
@@ -1296,15 +1291,26 @@ def simplify(exp, context={}):
     >>> simplify(parse('${{ inputs.empty }}'), {'inputs': {'empty': ''}})
     ''
 
+    >>> simplify(Lookup('a', 'b'), {'a': {'b': Value('c')}, 'c': 'd'})
+    'd'
+    >>> simplify(Lookup('a', Value('b')), {'a': {'x': 1}})
+    Lookup('a', Value(b))
+
     """
-    if isinstance(exp, Expression):
-        exp = str(exp)
-    elif not isinstance(exp, str):
-        return exp
+    if isinstance(exp, Var):
+        # Most expressions are just a lookup like `inputs.value`, which can be
+        # evaluated directly without going back through the string form.
+        o = var_eval(exp, context)
+    else:
+        if isinstance(exp, Expression):
+            exp = str(exp)
+        elif not isinstance(exp, str):
+            return exp
+
+        assert isinstance(exp, str), (exp, repr(exp))
 
-    assert isinstance(exp, str), (exp, repr(exp))
+        o = tokens_eval(_tokenizer(exp), context)
 
-    o = tokens_eval(tokenizer(exp), context)
     if isinstance(o, Value):
         if o in context:
             o = context[o]
@@ -1344,15 +1350,52 @@ def parse(s):
     hashFiles('**/package-lock.json')
     >>> parse("${{ hashFiles('**/package-lock.json', '**/Gemfile.lock') }}")
     hashFiles('**/package-lock.json', '**/Gemfile.lock')
+
+    Parsed expressions are cached, so the same expression text gives back the
+    same object.
+    >>> parse('${{ hello && world }}') is parse('${{hello && world}}')
+    True
+
+    Lists and dicts can be modified, so each caller gets their own copy.
+    >>> l = parse("${{ fromJSON('[1, 2]') }}")
+    >>> l.append(3)
+    >>> parse("${{ fromJSON('[1, 2]') }}")
+    [1, 2]
     """
     if isinstance(s, str):
         exp = s.strip()
         if exp.startswith('${{'):
             assert exp.endswith('}}'), exp
-            return simplify(exp[3:-2].strip())
+            return _parse_exp(exp[3:-2].strip())
     return s
 
 
+@functools.lru_cache(maxsize=4096)
+def _tokenizer(exp):
+    # Expressions which can't be fully simplified are simplified again from
+    # their string form each time they are used with a new context. The token
+    # tree is only read by tokens_eval, so it can be shared.
+    return tokenizer(exp)
+
+
+def _parse_exp(exp):
+    v = _parse_exp_cached(exp)
+    # Expressions like `fromJSON('[1, 2]')` simplify to a list or dict, which
+    # the caller is free to modify, so they can't be shared.
+    if isinstance(v, (list, dict)):
+        v = copy.deepcopy(v)
+    return v
+
+
+@functools.lru_cache(maxsize=4096)
+def _parse_exp_cached(exp):
+    # The same input defaults and `if` conditions get parsed every time an
+    # action is included. Expression objects are never modified after they
+    # are created, so those (and other immutable values) can be shared between
+    # callers.
+    return simplify(exp)
+
+
 RE_EXP = re.compile('\\${{(.*?)}}', re.DOTALL)
 
 
@@ -1374,22 +1417,41 @@ def eval(s, context):
     >>> eval(' ${{ a }}', {'a': 1})
     ' 1'
 
+    >>> eval('${{ a }} and ${{ b }}', {'a': 1})
+    '1 and ${{ b }}'
+
+    >>> eval("a ${{ 'x' }} b", {})
+    'a x b'
+    >>> eval("a ${{ 'x' }} b", {'x': 'X'})
+    'a x b'
+
     """
 
-    exp_bits = s[:3] + s[-2:]
-    mid_bits = s[3:-2]
-    if exp_bits == '${{}}' and '${{' not in mid_bits:
+    assert isinstance(s, str), (type(s), repr(s))
+    if '${{' not in s:
+        return s
+
+    if s.startswith('${{') and s.endswith('}}') and '${{' not in s[3:-2]:
         newe = parse(s)
         return simplify(newe, context)
 
-    assert isinstance(s, str), (type(s), repr(s))
-    def replace_exp(m):
-        e = m.group(1).strip()
-        v = simplify(e, context)
-        if isinstance(v, Expression):
-            return '${{ %s }}' % (v,)
-        else:
-            return str(v)
+    # Strings normally only contain a single expression, so handle that without
+    # the callback machinery of re.sub.
+    m = RE_EXP.search(s)
+    if m is not None and '${{' not in s[m.end():]:
+        return s[:m.start()] + _eval_replace_exp(context, m) + s[m.end():]
 
-    new_s = RE_EXP.sub(replace_exp, s)
+    new_s = RE_EXP.sub(functools.partial(_eval_replace_exp, context), s)
     return new_s
+
+
+def _eval_replace_exp(context, m):
+    v = _parse_exp(m.group(1).strip())
+    # Only expressions still need the context applied, anything else (like a
+    # string literal) is already the final value.
+    if isinstance(v, Expression):
+        v = simplify(v, context)
+    if isinstance(v, Expression):
+        return '${{ %s }}' % (v,)
+    else:
+        return str(v)
@@ -17,10 +17,16 @@
 # SPDX-License-Identifier: Apache-2.0
 
 
-import os.path
+import functools
+import os
 import pathlib
+import posixpath
+import re
+import threading
+import time
 import urllib
-import urllib.request
+import urllib.error
+import urllib.parse
 
 from collections import namedtuple
 
@@ -56,6 +62,9 @@ class RemoteFilePath(_RemoteFilePath, FilePath):
             user=self.user, repo=self.repo, path=self.path, ref=self.ref)
 
 
+# The same remote action is often used from many files, which get_filepath
+# caches separately.
+@functools.lru_cache(maxsize=1024)
 def parse_remote_path(action_name):
     """Convert action name into a FilePath object."""
     assert not action_name.startswith('docker://'), action_name
@@ -71,6 +80,9 @@ def parse_remote_path(action_name):
     return RemoteFilePath(user, repo, ref, path)
 
 
+# Includes of the same file from the same place resolve to the same path, and
+# the resolution can print messages, so only do it once.
+@functools.lru_cache(maxsize=1024)
 def get_filepath(current, filepath, filetype=None):
     """
     >>> localfile_current = LocalFilePath(pathlib.Path('/path'), 'abc.yaml')
@@ -83,6 +95,19 @@ def get_filepath(current, filepath, filetype=None):
     >>> str(fp)
     '/path/.github/actions/blah'
 
+    >>> get_filepath(localfile_current, './.github/../actions/./blah/')
+    LocalFilePath(repo_root=PosixPath('/path'), path=PosixPath('actions/blah'))
+
+    Paths outside the repository are rejected.
+    >>> get_filepath(localfile_current, './../blah')
+    Traceback (most recent call last):
+    ...
+    ValueError: ./../blah is outside the repository /path
+    >>> get_filepath(localfile_current, './/etc/passwd')
+    Traceback (most recent call last):
+    ...
+    ValueError: .//etc/passwd is outside the repository /path
+
     >>> fp = get_filepath(localfile_current, '/blah', 'action')
     >>> fp
     LocalFilePath(repo_root=PosixPath('/path'), path=PosixPath('.github/includes/actions/blah'))
@@ -132,9 +157,14 @@ def get_filepath(current, filepath, filetype=None):
     # Local file
     if filepath.startswith('./'):
         assert isinstance(current, LocalFilePath), (current, filepath)
-        localpath = (current.repo_root / filepath[2:]).resolve()
-        repopath = localpath.relative_to(current.repo_root)
-        return current._replace(path=repopath)
+        # Normalise the path as a string rather than with Path.resolve(), which
+        # has to stat every component of the path.
+        repopath = os.path.normpath(filepath[2:])
+        if (os.path.isabs(repopath)
+                or repopath == '..' or repopath.startswith('../')):
+            raise ValueError('{} is outside the repository {}'.format(
+                filepath, current.repo_root))
+        return current._replace(path=pathlib.Path(repopath))
 
     # Remote file
     else:
@@ -142,32 +172,388 @@ def get_filepath(current, filepath, filetype=None):
 
 
 DOWNLOAD_CACHE = {}
+DOWNLOAD_THREADS = 8
+
+
+# Connections are kept open between downloads, so each thread only pays for
+# the TLS handshake once per host.
+HTTP_CONNECTIONS = threading.local()
+
+
+def urlopen_etag(url, etag=None):
+    """Fetch url with urllib, returning the text and its ETag."""
+    import urllib.request
+
+    headers = {}
+    if etag is not None:
+        headers['If-None-Match'] = etag
+    try:
+        resp = urllib.request.urlopen(urllib.request.Request(url, headers=headers))
+    except urllib.error.HTTPError as e:
+        if e.code == 304:
+            return None, etag
+        raise
+    return resp.read().decode('utf-8'), resp.headers.get('ETag', None)
+
+
+def fetch_url_etag(url, etag=None):
+    """Fetch url over a kept alive HTTPS connection, returning the text and its ETag.
+
+    If `etag` is given and still matches the file, the text returned is None.
+
+    >>> import http.client, urllib.request
+    >>> class FakeResponse:
+    ...     reason = 'OK'
+    ...     headers = {}
+    ...     def __init__(self, status, body, etag):
+    ...         self.status, self.body, self.etag = status, body, etag
+    ...     def read(self):
+    ...         return self.body
+    ...     def getheader(self, name, default=None):
+    ...         return self.etag if name == 'ETag' else default
+    >>> class FakeConnection:
+    ...     def __init__(self, host):
+    ...         print('Connecting to', host)
+    ...     def request(self, method, path, headers):
+    ...         self.etag = headers.get('If-None-Match', None)
+    ...     def getresponse(self):
+    ...         if self.etag == '"e1"':
+    ...             return FakeResponse(304, b'', None)
+    ...         return FakeResponse(200, b'data', '"e1"')
+    >>> old = http.client.HTTPSConnection, urllib.request.getproxies
+    >>> http.client.HTTPSConnection = FakeConnection
+    >>> urllib.request.getproxies = lambda: {}
+    >>> HTTP_CONNECTIONS.__dict__.clear()
+
+    The connection is kept open for later requests to the same host.
+    >>> fetch_url_etag('https://example.com/a.yml')
+    Connecting to example.com
+    ('data', '"e1"')
+    >>> fetch_url_etag('https://example.com/a.yml', '"e1"')
+    (None, '"e1"')
+
+    >>> HTTP_CONNECTIONS.__dict__.clear()
+    >>> http.client.HTTPSConnection, urllib.request.getproxies = old
+    """
+    # Only imported when something needs downloading, as these are slow to
+    # import and most runs only use local files.
+    import http.client
+    import urllib.request
+
+    parts = urllib.parse.urlsplit(url)
+    if parts.scheme != 'https' or urllib.request.getproxies().get('https'):
+        return urlopen_etag(url, etag)
+
+    headers = {}
+    if etag is not None:
+        headers['If-None-Match'] = etag
+
+    connections = HTTP_CONNECTIONS.__dict__
+    path = parts.path + ('?' + parts.query if parts.query else '')
+    for retry in (True, False):
+        conn = connections.get(parts.netloc, None)
+        if conn is None:
+            conn = connections[parts.netloc] = http.client.HTTPSConnection(parts.netloc)
+        try:
+            conn.request('GET', path, headers=headers)
+            resp = conn.getresponse()
+            body = resp.read()
+            break
+        except (http.client.HTTPException, OSError) as e:
+            # The server may have closed an idle connection, try again once on
+            # a new one.
+            conn.close()
+            del connections[parts.netloc]
+            if not retry:
+                raise urllib.error.URLError(e)
+
+    if resp.status == 304:
+        return None, etag
+    if 300 <= resp.status < 400:
+        # Let urllib deal with following redirects.
+        return urlopen_etag(url, etag)
+    if resp.status != 200:
+        raise urllib.error.HTTPError(url, resp.status, resp.reason, resp.headers, None)
+    return body.decode('utf-8'), resp.getheader('ETag', None)
+
+
+# Downloaded files are kept on disk between runs. Files at a fixed commit never
+# change, so they are always used. Branches and tags can move, so they are only
+# used without checking for changes for DISK_CACHE_TTL seconds (by default,
+# never). After that they are revalidated using their ETag, so an unchanged
+# file isn't downloaded again.
+DISK_CACHE_DIR = pathlib.Path(
+    os.environ.get('ACTIONS_INCLUDES_CACHE', '') or os.path.join(
+        os.environ.get('XDG_CACHE_HOME', '') or os.path.expanduser('~/.cache'),
+        'actions-includes'))
+
+
+def get_disk_cache_ttl(value):
+    """Parse the ACTIONS_INCLUDES_CACHE_TTL value, ignoring it if invalid.
+
+    >>> get_disk_cache_ttl('3600')
+    3600.0
+    >>> get_disk_cache_ttl('')
+    0.0
+    >>> get_disk_cache_ttl('1h')
+    0.0
+    """
+    try:
+        return float(value or 0)
+    except ValueError:
+        printerr("Ignoring invalid ACTIONS_INCLUDES_CACHE_TTL value {!r}".format(value))
+        return 0.0
+
+
+DISK_CACHE_TTL = get_disk_cache_ttl(os.environ.get('ACTIONS_INCLUDES_CACHE_TTL', ''))
+
+RE_COMMIT_SHA = re.compile('^[0-9a-f]{40}$')
+
+
+def get_disk_cache_path(filepath):
+    """Where the contents of filepath are kept on disk, None if they aren't.
+
+    >>> sha = '0123456789abcdef0123456789abcdef01234567'
+    >>> p = get_disk_cache_path(RemoteFilePath('user', 'repo', sha, 'a/action.yml'))
+    >>> p.relative_to(DISK_CACHE_DIR).parts
+    ('user', 'repo', '0123456789abcdef0123456789abcdef01234567', 'a', 'action.yml')
+
+    Refs can contain `/`, so they are quoted to keep them as one directory.
+    >>> p = get_disk_cache_path(RemoteFilePath('user', 'repo', 'a/b', 'action.yml'))
+    >>> p.relative_to(DISK_CACHE_DIR).parts
+    ('user', 'repo', 'a%2Fb', 'action.yml')
+
+    Actions at the root of a repository have a path starting with `/`.
+    >>> p = get_disk_cache_path(RemoteFilePath('user', 'repo', sha, '/action.yml'))
+    >>> p.relative_to(DISK_CACHE_DIR).parts
+    ('user', 'repo', '0123456789abcdef0123456789abcdef01234567', 'action.yml')
+
+    >>> get_disk_cache_path(RemoteFilePath('user', 'repo', sha, '../action.yml'))
+    """
+    ref = urllib.parse.quote(filepath.ref, safe='')
+    path = posixpath.normpath(filepath.path.lstrip('/'))
+    if path in ('.', '..') or path.startswith('../'):
+        return None
+    for name in (filepath.user, filepath.repo, ref):
+        if name in ('', '.', '..'):
+            return None
+    return DISK_CACHE_DIR.joinpath(filepath.user, filepath.repo, ref, path)
+
+
+def is_disk_cache_fresh(filepath, cache_path):
+    """Can the copy of filepath at cache_path be used without downloading?"""
+    if RE_COMMIT_SHA.match(filepath.ref):
+        return True
+    if DISK_CACHE_TTL <= 0:
+        return False
+    try:
+        return time.time() - cache_path.stat().st_mtime < DISK_CACHE_TTL
+    except OSError:
+        return False
+
+
+def get_dir_filepaths(dirpath, names):
+    """The files to look for when looking for any of `names` in dirpath.
+
+    When one of them is already in the disk cache (and still fresh), an
+    earlier run looked for all of the names and that is the one it used. Only
+    that file is needed then, rather than asking the server for the others
+    again on every run.
+    """
+    filepaths = [dirpath._replace(path=str(dirpath.path)+f) for f in names]
+    if isinstance(dirpath, RemoteFilePath):
+        for filepath in filepaths:
+            cache_path = get_disk_cache_path(filepath)
+            if cache_path is None or not cache_path.exists():
+                continue
+            if is_disk_cache_fresh(filepath, cache_path):
+                return [filepath]
+    return filepaths
+
+
+def write_disk_cache(cache_path, data):
+    """Save data to cache_path, returning False if it couldn't be saved."""
+    # Write to a temporary file first, so another run (or download thread)
+    # never sees a partially written file.
+    tmp_path = cache_path.with_name('{}.{}.{}.tmp'.format(
+        cache_path.name, os.getpid(), threading.get_ident()))
+    try:
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path.write_bytes(data.encode('utf-8'))
+        os.replace(tmp_path, cache_path)
+    except OSError as e:
+        printerr("Unable to save {} ({})".format(cache_path, e))
+        return False
+    return True
+
+
+def download_filepath_data(filepath):
+    """Download filepath, going through the disk cache.
+
+    >>> import shutil, tempfile
+    >>> from actions_includes import files
+    >>> old = files.DISK_CACHE_DIR, files.DISK_CACHE_TTL, files.fetch_url_etag
+    >>> files.DISK_CACHE_DIR = pathlib.Path(tempfile.mkdtemp())
+    >>> def fake_fetch_url_etag(url, etag=None):
+    ...     print('Fetching', url.rsplit('/', 2)[-2], 'with ETag', etag)
+    ...     return responses.pop(0)
+    >>> files.fetch_url_etag = fake_fetch_url_etag
+    >>> fp = RemoteFilePath('user', 'repo', 'main', 'a/action.yml')
+
+    The first download is saved along with its ETag.
+    >>> responses = [('v1', '"e1"')]
+    >>> download_filepath_data(fp)
+    Fetching a with ETag None
+    'v1'
+
+    Branches can move, so the cached copy is checked with the server again.
+    If it hasn't changed, the cached copy is used.
+    >>> responses = [(None, '"e1"')]
+    >>> download_filepath_data(fp)
+    Fetching a with ETag "e1"
+    'v1'
+
+    If it has changed, the new version replaces the cached copy.
+    >>> responses = [('v2', '"e2"')]
+    >>> download_filepath_data(fp)
+    Fetching a with ETag "e1"
+    'v2'
+    >>> get_disk_cache_path(fp).read_text()
+    'v2'
+
+    Within DISK_CACHE_TTL the cached copy is used without asking the server.
+    >>> files.DISK_CACHE_TTL = 3600
+    >>> download_filepath_data(fp)
+    'v2'
+    >>> files.DISK_CACHE_TTL = 0
+
+    Files at a commit never change, so once cached they are always used. The
+    other possible names of the file don't need looking for either.
+    >>> fp_sha = fp._replace(ref='0123456789abcdef0123456789abcdef01234567')
+    >>> responses = [('v3', None)]
+    >>> download_filepath_data(fp_sha)
+    Fetching a with ETag None
+    'v3'
+    >>> download_filepath_data(fp_sha)
+    'v3'
+    >>> [str(p) for p in get_dir_filepaths(
+    ...     fp_sha._replace(path='a'), ['/action.yaml', '/action.yml'])]
+    ['user/repo/a/action.yml@0123456789abcdef0123456789abcdef01234567']
+
+    >>> shutil.rmtree(files.DISK_CACHE_DIR)
+    >>> files.DISK_CACHE_DIR, files.DISK_CACHE_TTL, files.fetch_url_etag = old
+    """
+    assert isinstance(filepath, RemoteFilePath), (type(filepath), filepath)
+    url = 'https://raw.githubusercontent.com/{user}/{repo}/{ref}/{path}'.format(
+        **filepath._asdict())
+
+    cache_path = get_disk_cache_path(filepath)
+    cached_data, etag = None, None
+    if cache_path is not None:
+        etag_path = cache_path.with_name(cache_path.name + '.etag')
+        try:
+            cached_data = cache_path.read_bytes().decode('utf-8')
+            if is_disk_cache_fresh(filepath, cache_path):
+                printerr("Using {} from {}".format(url, cache_path))
+                return cached_data
+            etag = etag_path.read_text().strip() or None
+        except OSError:
+            pass
+
+    try:
+        yaml_data, new_etag = fetch_url_etag(url, etag)
+    except urllib.error.URLError as e:
+        printerr("Trying to download {} .. Failed ({})!".format(url, e))
+        return e
+
+    if yaml_data is None:
+        printerr("Trying to download {} .. Not modified!".format(url))
+        try:
+            # Restart the DISK_CACHE_TTL period.
+            os.utime(cache_path)
+        except OSError:
+            pass
+        return cached_data
+    printerr("Trying to download {} .. Success!".format(url))
+
+    if cache_path is not None and write_disk_cache(cache_path, yaml_data):
+        if new_etag:
+            write_disk_cache(etag_path, new_etag)
+        else:
+            try:
+                etag_path.unlink()
+            except OSError:
+                pass
+    return yaml_data
+
+
+@functools.lru_cache(maxsize=None)
+def get_download_executor():
+    """The thread pool used for downloads.
+
+    It is shared by every prefetch, so the download threads (and the
+    connections they keep open in HTTP_CONNECTIONS) last for the whole run
+    rather than just one directory or level of includes.
+    """
+    import concurrent.futures
+    return concurrent.futures.ThreadPoolExecutor(
+        DOWNLOAD_THREADS, thread_name_prefix='download')
+
+
+def prefetch_filepath_data(filepaths):
+    """Download the remote files in filepaths in parallel.
+
+    The results end up in DOWNLOAD_CACHE so later get_filepath_data calls
+    don't have to wait on the network.
+    """
+    to_download = []
+    for filepath in filepaths:
+        if not isinstance(filepath, RemoteFilePath):
+            continue
+        if filepath in DOWNLOAD_CACHE or filepath in to_download:
+            continue
+        to_download.append(filepath)
+
+    if len(to_download) < 2:
+        return
+
+    results = get_download_executor().map(download_filepath_data, to_download)
+    for filepath, yaml_data in zip(to_download, results):
+        DOWNLOAD_CACHE[filepath] = yaml_data
+
+
+def read_filepath_data(filepath):
+    assert isinstance(filepath, LocalFilePath), (type(filepath), filepath)
+    filename = filepath.repo_root / filepath.path
+    try:
+        with open(filename, 'rb') as f:
+            data = f.read()
+    except (FileNotFoundError, NotADirectoryError):
+        return IOError('{} does not exist'.format(filename))
+    # Decoding in one go is quicker than going through a text mode file,
+    # but the newlines need to be translated the same way.
+    data = data.decode('utf-8')
+    if '\r' in data:
+        data = data.replace('\r\n', '\n').replace('\r', '\n')
+    return data
+
+
+# The same local action is often included many times, and the files don't
+# change while we are running.
+LOCAL_CACHE = {}
 
 
 def get_filepath_data(filepath):
     # Get local data
     if isinstance(filepath, LocalFilePath):
-        filename = filepath.repo_root / filepath.path
-        if not filename.exists():
-            return IOError('{} does not exist'.format(filename))
-        with open(filename) as f:
-            return f.read()
+        if filepath not in LOCAL_CACHE:
+            LOCAL_CACHE[filepath] = read_filepath_data(filepath)
+        return LOCAL_CACHE[filepath]
 
     # Download remote data
     elif isinstance(filepath, RemoteFilePath):
         if filepath not in DOWNLOAD_CACHE:
-            url = 'https://raw.githubusercontent.com/{user}/{repo}/{ref}/{path}'.format(
-                **filepath._asdict())
-
-            printerr("Trying to download {} ..".format(url), end=' ')
-            try:
-                yaml_data = urllib.request.urlopen(url).read().decode('utf-8')
-                printerr('Success!')
-            except urllib.error.URLError as e:
-                yaml_data = e
-                printerr('Failed ({})!'.format(e))
-
-            DOWNLOAD_CACHE[filepath] = yaml_data
+            DOWNLOAD_CACHE[filepath] = download_filepath_data(filepath)
         return DOWNLOAD_CACHE[filepath]
     else:
         assert False
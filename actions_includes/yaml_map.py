@@ -65,7 +65,8 @@ class YamlMap:
         self.__i = 0
         self._keys = defaultdict(list)
         self._values = {}
-        self._order = []
+        # Insertion ordered mapping of index to key, so deleting is O(1).
+        self._order = {}
         if d:
             if hasattr(d, 'items'):
                 d = d.items()
@@ -86,7 +87,7 @@ class YamlMap:
         assert self.__i not in self._order
         self._keys[k].append(self.__i)
         self._values[self.__i] = v
-        self._order.append((self.__i, k))
+        self._order[self.__i] = k
 
     def replace(self, k, v, allow_missing=False):
         if k not in self._keys:
@@ -105,7 +106,7 @@ class YamlMap:
         to_remove = self._keys[k]
         for i in to_remove:
             del self._values[i]
-            self._order.remove((i, k))
+            del self._order[i]
         del self._keys[k]
 
     def get(self, k, default=_MARKER):
@@ -124,7 +125,7 @@ class YamlMap:
             self.m = m
 
         def __iter__(self):
-            for i, k in self.m._order:
+            for i, k in self.m._order.items():
                 v = self.m._values[i]
                 yield (k, v)
 
@@ -139,7 +140,7 @@ class YamlMap:
             self.m = m
 
         def __iter__(self):
-            for i, k in self.m._order:
+            for k in self.m._order.values():
                 yield k
 
         def __len__(self):
@@ -153,7 +154,7 @@ class YamlMap:
             self.m = m
 
         def __iter__(self):
-            for i, _ in self.m._order:
+            for i in self.m._order:
                 yield self.m._values[i]
 
         def __len__(self):